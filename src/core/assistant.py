@@ -3,11 +3,16 @@ Main Recipe Assistant class that coordinates between the model, vector store, an
 """
 
 from typing import List, Dict, Optional, Union
+import asyncio
+import hashlib
 import logging
+import os
+import threading
 from pathlib import Path
 import torch
 import numpy as np
 
+from .cache import SemanticCache
 from .model import ModelManager
 from .vector_store import RecipeVectorStore
 
@@ -17,7 +22,17 @@ class RecipeAssistant:
     def __init__(
         self,
         vector_store_path: Optional[str] = None,
-        device: Optional[str] = None
+        device: Optional[str] = None,
+        index_type: str = 'flat',
+        nlist: int = 100,
+        pq_m: int = 48,
+        quantization: Optional[str] = None,
+        gguf_path: Optional[str] = None,
+        compile_embeddings: bool = False,
+        quantize_embeddings: bool = False,
+        cache_threshold: float = 0.9,
+        mmap_index: bool = False,
+        dtype: Optional[torch.dtype] = None
     ):
         """
         Initialize the Recipe Assistant.
@@ -25,14 +40,56 @@ class RecipeAssistant:
         Args:
             vector_store_path: Optional path to existing vector store
             device: Optional device specification for models
+            index_type: FAISS index structure ('flat', 'hnsw', 'ivf', 'ivfpq',
+                'pq_fastscan' or 'binary'); trained types search a flat staging
+                index until enough recipes have been added to train them
+                (39 * nlist for 'ivf', 39 * max(nlist, 256) for 'ivfpq', 624
+                for 'pq_fastscan')
+            nlist: Number of IVF cells for 'ivf' and 'ivfpq'
+            pq_m: Number of product-quantizer sub-vectors for 'ivfpq' and 'pq_fastscan'
+            quantization: Optional Phi-2 weight quantization ('8bit', '4bit' or 'fp8')
+            gguf_path: Optional GGUF Phi-2 checkpoint to generate with via llama.cpp
+            compile_embeddings: Compile the embedding encoder with torch.compile
+            quantize_embeddings: Run the embedding encoder with INT8 linear layers (CPU only)
+            cache_threshold: Cosine similarity above which a previously answered
+                question's response is reused
+            mmap_index: Load the vector store at vector_store_path read-only,
+                memory-mapping the inverted lists of 'ivf' and 'ivfpq' indexes
+                (other index types are still read into RAM)
+            dtype: Optional floating point type for the Phi-2 weights (auto-detected if None)
         """
         # Initialize components
-        self.model_manager = ModelManager(device=device)
+        self.model_manager = ModelManager(
+            device=device,
+            quantization=quantization,
+            gguf_path=gguf_path,
+            compile_embeddings=compile_embeddings,
+            quantize_embeddings=quantize_embeddings,
+            dtype=dtype
+        )
         self.vector_store = RecipeVectorStore(
             dimension=384,  # Dimension for all-MiniLM-L6-v2
-            index_path=vector_store_path
+            index_path=vector_store_path,
+            index_type=index_type,
+            nlist=nlist,
+            pq_m=pq_m,
+            use_gpu=self.model_manager.device == 'cuda',
+            mmap=mmap_index
         )
         
+        # Cached responses, one cache per number of context recipes
+        self.cache_threshold = cache_threshold
+        self.response_caches: Dict[int, SemanticCache] = {}
+        self._response_caches_lock = threading.Lock()
+        
+        # Formatted prompt context per recipe ID; recipes are immutable once stored
+        self._context_cache: Dict[int, str] = {}
+        
+        # Recipe embeddings keyed by a hash of the recipe text, so re-added recipes skip the encoder;
+        # the saved cache is only read once recipes are added or the state is saved
+        self._text_cache: Dict[bytes, np.ndarray] = {}
+        self._text_cache_source: Optional[str] = vector_store_path
+        
         # Define prompt templates
         self.qa_template = """
         Answer the following cooking or recipe related question. Use the provided context if relevant.
@@ -43,6 +100,11 @@ class RecipeAssistant:
         
         Answer: """
         
+        # Every QA prompt starts with the same instructions; encode them once
+        self.model_manager.set_prompt_prefix(
+            self.qa_template[:self.qa_template.index('{context}')].rstrip()
+        )
+        
         logger.info("Recipe Assistant initialized successfully")
 
     def add_recipe(self, recipe_data: Dict) -> int:
@@ -60,13 +122,17 @@ class RecipeAssistant:
             recipe_text = self._create_recipe_text(recipe_data)
             
             # Generate embedding
-            embedding = self.model_manager.get_embeddings([recipe_text])[0]
+            embedding = self._embed_recipe_texts([recipe_text])[0]
             
             # Add to vector store
             recipe_id = self.vector_store.add_recipe(
                 recipe_data,
-                embedding.cpu().numpy()
+                embedding
             )
+            self._context_cache[recipe_id] = self._format_context(recipe_data)
+            
+            # New recipes can change the context of any cached answer
+            self.response_caches.clear()
             
             return recipe_id
             
@@ -74,6 +140,38 @@ class RecipeAssistant:
             logger.error(f"Error adding recipe: {str(e)}")
             raise
 
+    def add_recipes(self, recipes: List[Dict], batch_size: int = 64) -> List[int]:
+        """
+        Add several recipes at once, embedding them in batched forward passes.
+        
+        Args:
+            recipes: List of dictionaries containing recipe information
+            batch_size: Number of recipes per embedding forward pass
+            
+        Returns:
+            List of recipe IDs, in the same order as the input
+        """
+        if not recipes:
+            return []
+        
+        try:
+            recipe_texts = [self._create_recipe_text(recipe) for recipe in recipes]
+            embeddings = self._embed_recipe_texts(recipe_texts, batch_size=batch_size)
+            
+            # Indexes that need training stage recipes and train once they hold enough
+            recipe_ids = self.vector_store.add_recipes(recipes, embeddings)
+            for recipe_id, recipe in zip(recipe_ids, recipes):
+                self._context_cache[recipe_id] = self._format_context(recipe)
+            
+            # New recipes can change the context of any cached answer
+            self.response_caches.clear()
+            
+            return recipe_ids
+            
+        except Exception as e:
+            logger.error(f"Error adding recipes: {str(e)}")
+            raise
+
     def query(self, question: str, k: int = 3) -> str:
         """
         Answer a cooking or recipe related question.
@@ -83,34 +181,96 @@ class RecipeAssistant:
             k: Number of relevant recipes to consider
             
         Returns:
-            Assistant's response
+            Assistant's answer, without the prompt
         """
         try:
+            cache = self._get_response_cache(k)
+            
+            # Repeated question: skip embedding, retrieval and generation
+            response = cache.get_exact(question)
+            if response is not None:
+                return response
+            
             # Generate question embedding
-            question_embedding = self.model_manager.get_embeddings([question])[0]
+            question_embedding = self.model_manager.get_embedding(question)
             
-            # Search for relevant recipes
-            results = self.vector_store.search_recipes(
-                question_embedding.cpu().numpy(),
-                k=k
-            )
+            return self._answer(question, question_embedding, cache, k)
             
-            # Create context from relevant recipes
-            context = self._create_context(results)
+        except Exception as e:
+            logger.error(f"Error processing query: {str(e)}")
+            raise
+
+    def query_batch(self, questions: List[str], k: int = 3) -> List[str]:
+        """
+        Answer several cooking or recipe related questions.
+        
+        Questions without a cached answer are embedded together in one batch,
+        and their prompts are generated together in one batch.
+        
+        Args:
+            questions: User's questions
+            k: Number of relevant recipes to consider per question
             
-            # Generate response using Phi-2
-            prompt = self.qa_template.format(
-                context=context,
-                question=question
-            )
+        Returns:
+            Assistant's answers without the prompts, in the same order as the questions
+        """
+        try:
+            cache = self._get_response_cache(k)
             
-            response = self.model_manager.generate_text(prompt)
-            return response
+            responses = [cache.get_exact(question) for question in questions]
+            
+            # Uncached questions with the same exact-match key are answered once
+            duplicates: Dict[str, List[int]] = {}
+            for i, response in enumerate(responses):
+                if response is None:
+                    duplicates.setdefault(cache.normalize(questions[i]), []).append(i)
+            pending = [indices[0] for indices in duplicates.values()]
+            
+            if pending:
+                question_embeddings = dict(zip(pending, self.model_manager.get_embeddings(
+                    [questions[i] for i in pending]
+                )))
+                
+                prompts = {}
+                for i, question_embedding in question_embeddings.items():
+                    # Near-duplicate question: skip retrieval and generation
+                    responses[i] = cache.get_similar(question_embedding)
+                    if responses[i] is None:
+                        prompts[i] = self._build_prompt(questions[i], question_embedding, k)
+                
+                if prompts:
+                    generated = self.model_manager.generate_texts(list(prompts.values()))
+                    for i, response in zip(prompts, generated):
+                        cache.put(questions[i], question_embeddings[i], response)
+                        responses[i] = response
+            
+            for first, *others in duplicates.values():
+                for i in others:
+                    responses[i] = responses[first]
+            
+            return responses
             
         except Exception as e:
-            logger.error(f"Error processing query: {str(e)}")
+            logger.error(f"Error processing queries: {str(e)}")
             raise
 
+    async def aquery(self, question: str, k: int = 3) -> str:
+        """
+        Answer a question without blocking the event loop.
+        
+        Embedding, search and transformers generation release the GIL, so
+        concurrent calls overlap in worker threads; generation through a
+        GGUF model is serialized because llama.cpp is not thread-safe.
+        
+        Args:
+            question: User's question
+            k: Number of relevant recipes to consider
+            
+        Returns:
+            Assistant's answer, without the prompt
+        """
+        return await asyncio.to_thread(self.query, question, k)
+
     def find_similar_recipes(
         self,
         recipe_id: Optional[int] = None,
@@ -129,74 +289,198 @@ class RecipeAssistant:
             List of similar recipes with their similarity scores
         """
         try:
+            query_embedding = None
             if recipe_id is not None:
                 # Get reference recipe
                 recipe = self.vector_store.get_recipe(recipe_id)
                 if not recipe:
                     raise ValueError(f"Recipe with ID {recipe_id} not found")
-                query_text = self._create_recipe_text(recipe)
+                # Reuse the vector stored at insert time instead of re-encoding
+                query_embedding = self.vector_store.get_embedding(recipe_id)
+                if query_embedding is None:
+                    query_text = self._create_recipe_text(recipe)
             elif recipe_text is not None:
                 query_text = recipe_text
             else:
                 raise ValueError("Either recipe_id or recipe_text must be provided")
             
             # Generate embedding
-            query_embedding = self.model_manager.get_embeddings([query_text])[0]
+            if query_embedding is None:
+                query_embedding = self.model_manager.get_embedding(query_text)
             
             # Search vector store
             results = self.vector_store.search_recipes(
-                query_embedding.cpu().numpy(),
+                query_embedding,
                 k=k
             )
             
             return [
                 {
                     'recipe': recipe_data,
-                    'similarity_score': 1 - (distance / 2)  # Convert L2 distance to similarity
+                    'similarity_score': similarity  # Cosine similarity from the inner-product index
                 }
-                for _, distance, recipe_data in results
+                for _, similarity, recipe_data in results
             ]
             
         except Exception as e:
             logger.error(f"Error finding similar recipes: {str(e)}")
             raise
 
+    def _get_response_cache(self, k: int) -> SemanticCache:
+        """Get the response cache for answers built from k context recipes."""
+        # Concurrent aquery calls must not each create, and then drop, a cache for k
+        with self._response_caches_lock:
+            if k not in self.response_caches:
+                self.response_caches[k] = SemanticCache(dimension=384, threshold=self.cache_threshold)
+            return self.response_caches[k]
+
+    def _answer(
+        self,
+        question: str,
+        question_embedding: np.ndarray,
+        cache: SemanticCache,
+        k: int
+    ) -> str:
+        """Answer an embedded question, consulting and filling the semantic cache."""
+        # Near-duplicate question: skip retrieval and generation
+        response = cache.get_similar(question_embedding)
+        if response is not None:
+            return response
+        
+        # Generate response using Phi-2
+        prompt = self._build_prompt(question, question_embedding, k)
+        response = self.model_manager.generate_text(prompt)
+        cache.put(question, question_embedding, response)
+        return response
+
+    def _build_prompt(self, question: str, question_embedding: np.ndarray, k: int) -> str:
+        """Retrieve the k most relevant recipes and build the QA prompt."""
+        # Search for relevant recipes
+        results = self.vector_store.search_recipes(
+            question_embedding,
+            k=k
+        )
+        
+        # Create context from relevant recipes
+        context = self._create_context(results)
+        
+        return self.qa_template.format(
+            context=context,
+            question=question
+        )
+
+    def _embed_recipe_texts(self, recipe_texts: List[str], batch_size: int = 64) -> np.ndarray:
+        """Embed recipe texts, encoding only those not seen before."""
+        # Read-only stores reject new recipes, so their saved cache is never needed
+        if not self.vector_store.read_only:
+            self._ensure_text_cache()
+        
+        keys = [
+            hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+            for text in recipe_texts
+        ]
+        missing = [i for i, key in enumerate(keys) if key not in self._text_cache]
+        
+        if missing:
+            embeddings = self.model_manager.get_embeddings(
+                [recipe_texts[i] for i in missing],
+                batch_size=batch_size
+            )
+            for i, embedding in zip(missing, embeddings):
+                self._text_cache[keys[i]] = embedding
+        
+        return np.stack([self._text_cache[key] for key in keys])
+
+    def _text_cache_path(self, path: str) -> str:
+        """Path of the embedding cache saved with the store at path, per encoder variant."""
+        return f"{path}.embeddings.{self.model_manager.embedding_variant}.npz"
+
+    def _ensure_text_cache(self):
+        """Load the saved embedding cache of the current store on first use."""
+        if self._text_cache_source is not None:
+            self._load_text_cache(self._text_cache_source)
+            self._text_cache_source = None
+
+    def _load_text_cache(self, path: str):
+        """Load recipe embeddings cached by a previous save_state, if any."""
+        cache_path = self._text_cache_path(path)
+        if not os.path.exists(cache_path):
+            return
+        
+        with np.load(cache_path) as data:
+            self._text_cache.update(
+                (key.tobytes(), embedding)
+                for key, embedding in zip(data['keys'], data['embeddings'])
+            )
+        logger.info(f"Loaded {len(self._text_cache)} cached recipe embeddings from {cache_path}")
+
+    def _save_text_cache(self, path: str):
+        """Save the cached recipe embeddings next to the vector store."""
+        # Carry over entries saved earlier that this session never loaded
+        self._ensure_text_cache()
+        if not self._text_cache:
+            return
+        
+        keys = np.frombuffer(b''.join(self._text_cache), dtype=np.uint8).reshape(-1, 16)
+        np.savez(
+            self._text_cache_path(path),
+            keys=keys,
+            embeddings=np.stack(list(self._text_cache.values()))
+        )
+
     def _create_recipe_text(self, recipe_data: Dict) -> str:
         """Create a text representation of a recipe for embedding."""
-        parts = [
-            recipe_data.get('title', ''),
-            recipe_data.get('description', ''),
-            'Ingredients: ' + '; '.join(recipe_data.get('ingredients', [])),
-            'Instructions: ' + ' '.join(recipe_data.get('instructions', [])),
-            'Tags: ' + ', '.join(recipe_data.get('tags', []))
-        ]
-        return ' '.join(filter(None, parts))
+        # The labelled sections are always present, so only title and description
+        # can be empty; the output must stay stable because it keys the embedding cache
+        body = (
+            f"Ingredients: {'; '.join(recipe_data.get('ingredients', []))} "
+            f"Instructions: {' '.join(recipe_data.get('instructions', []))} "
+            f"Tags: {', '.join(recipe_data.get('tags', []))}"
+        )
+        title = recipe_data.get('title', '')
+        description = recipe_data.get('description', '')
+        if title and description:
+            return f"{title} {description} {body}"
+        if title or description:
+            return f"{title or description} {body}"
+        return body
 
     def _create_context(self, results: List[tuple]) -> str:
         """Create a context string from search results."""
         context_parts = []
-        for _, _, recipe_data in results:
-            context_parts.append(
-                f"Recipe: {recipe_data.get('title', '')}\n"
-                f"Description: {recipe_data.get('description', '')}\n"
-                f"Ingredients: {'; '.join(recipe_data.get('ingredients', []))}\n"
-                f"Instructions: {' '.join(recipe_data.get('instructions', []))}\n"
-            )
+        for recipe_id, _, recipe_data in results:
+            # Recipes loaded from disk are formatted on first use
+            if recipe_id not in self._context_cache:
+                self._context_cache[recipe_id] = self._format_context(recipe_data)
+            context_parts.append(self._context_cache[recipe_id])
         return '\n'.join(context_parts)
 
+    def _format_context(self, recipe_data: Dict) -> str:
+        """Format a single recipe as a prompt context block."""
+        return (
+            f"Recipe: {recipe_data.get('title', '')}\n"
+            f"Description: {recipe_data.get('description', '')}\n"
+            f"Ingredients: {'; '.join(recipe_data.get('ingredients', []))}\n"
+            f"Instructions: {' '.join(recipe_data.get('instructions', []))}\n"
+        )
+
     def save_state(self, path: str):
         """Save the assistant's state to disk."""
         try:
             self.vector_store.save(path)
+            self._save_text_cache(path)
             logger.info(f"Saved assistant state to {path}")
         except Exception as e:
             logger.error(f"Error saving assistant state: {str(e)}")
             raise
 
-    def load_state(self, path: str):
-        """Load the assistant's state from disk."""
+    def load_state(self, path: str, mmap: bool = False):
+        """Load the assistant's state from disk, optionally memory-mapping the index read-only."""
         try:
-            self.vector_store.load(path)
+            self.vector_store.load(path, mmap=mmap)
+            self._text_cache_source = path
+            self._context_cache.clear()
+            self.response_caches.clear()
             logger.info(f"Loaded assistant state from {path}")
         except Exception as e:
             logger.error(f"Error loading assistant state: {str(e)}")
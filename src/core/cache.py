@@ -0,0 +1,107 @@
+"""
+Response cache for the Recipe Assistant.
+Short-circuits repeated and near-duplicate questions before retrieval and generation.
+"""
+
+import faiss
+import numpy as np
+from typing import Dict, List, Optional
+import string
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class SemanticCache:
+    def __init__(self, dimension: int = 384, threshold: float = 0.9, max_entries: int = 1024):
+        """
+        Initialize a two-tier question/response cache.
+
+        The first tier is an exact lookup on normalized question text; the second
+        compares question embeddings by cosine similarity.
+
+        Args:
+            dimension: Dimension of the question embeddings
+            threshold: Minimum cosine similarity for a semantic hit
+            max_entries: Number of cached responses kept before the cache is reset
+        """
+        self.dimension = dimension
+        self.threshold = threshold
+        self.max_entries = max_entries
+        # Punctuation becomes a separator so "1/2 cup" and "12 cup" stay distinct
+        self._punctuation = str.maketrans(string.punctuation, ' ' * len(string.punctuation))
+        # Guards the FAISS index, which does not support concurrent add and search
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Drop all cached responses."""
+        with self._lock:
+            self._reset()
+
+    def _reset(self):
+        """Drop all cached responses; the caller must hold the lock."""
+        self._exact: Dict[str, str] = {}
+        self._index = faiss.IndexFlatIP(self.dimension)
+        self._responses: List[str] = []
+
+    def normalize(self, text: str) -> str:
+        """Normalize question text to its exact-match key."""
+        return ' '.join(text.lower().translate(self._punctuation).split())
+
+    def _as_unit_vector(self, embedding: np.ndarray) -> np.ndarray:
+        """Return an L2-normalized float32 copy of the embedding with shape (1, d)."""
+        vector = np.array(embedding, dtype=np.float32).reshape(1, -1)
+        faiss.normalize_L2(vector)
+        return vector
+
+    def get_exact(self, question: str) -> Optional[str]:
+        """
+        Look up a response by normalized question text.
+
+        Args:
+            question: User's question
+
+        Returns:
+            Cached response or None on a miss
+        """
+        return self._exact.get(self.normalize(question))
+
+    def get_similar(self, embedding: np.ndarray) -> Optional[str]:
+        """
+        Look up the response of the most similar cached question.
+
+        Args:
+            embedding: Embedding of the user's question
+
+        Returns:
+            Cached response if its question is at least `threshold` similar, else None
+        """
+        vector = self._as_unit_vector(embedding)
+        with self._lock:
+            if self._index.ntotal == 0:
+                return None
+
+            scores, indices = self._index.search(vector, 1)
+            if indices[0][0] >= 0 and scores[0][0] >= self.threshold:
+                return self._responses[int(indices[0][0])]
+            return None
+
+    def put(self, question: str, embedding: np.ndarray, response: str):
+        """
+        Cache a response under both its question text and embedding.
+
+        Args:
+            question: User's question
+            embedding: Embedding of the question
+            response: Response to return for this and similar questions
+        """
+        vector = self._as_unit_vector(embedding)
+        with self._lock:
+            if len(self._responses) >= self.max_entries:
+                logger.info(f"Response cache reached {self.max_entries} entries; clearing")
+                self._reset()
+
+            self._exact[self.normalize(question)] = response
+            self._index.add(vector)
+            self._responses.append(response)
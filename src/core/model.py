@@ -3,48 +3,192 @@ Model initialization and management for the Recipe Assistant.
 Handles the setup of the local Phi-2 model and embeddings model.
 """
 
+import numpy as np
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, DynamicCache
 from sentence_transformers import SentenceTransformer
-from typing import List, Optional
+from typing import Dict, List, Optional
+from functools import lru_cache
+import copy
 import logging
+import os
+import threading
 
 logger = logging.getLogger(__name__)
 
 class ModelManager:
-    def __init__(self, device: Optional[str] = None):
+    def __init__(
+        self,
+        device: Optional[str] = None,
+        quantization: Optional[str] = None,
+        gguf_path: Optional[str] = None,
+        compile_embeddings: bool = False,
+        quantize_embeddings: bool = False,
+        dtype: Optional[torch.dtype] = None
+    ):
         """
         Initialize the model manager with Phi-2 and sentence transformer models.
         
         Args:
             device: Optional device specification ('cuda' or 'cpu'). If None, automatically detects.
+            quantization: Optional weight quantization for Phi-2 ('8bit', '4bit' for
+                NF4 with double quantization, or 'fp8' for torchao FP8 weights on
+                FP8-capable GPUs). Requires CUDA; ignored with a warning on CPU.
+            gguf_path: Optional path to a GGUF Phi-2 checkpoint (e.g. Q4_K_M). When set,
+                generation runs through llama.cpp instead of transformers.
+            compile_embeddings: Compile the embedding encoder with torch.compile.
+                Pays a one-off compilation cost for lower per-call overhead.
+            quantize_embeddings: Apply dynamic INT8 quantization to the embedding
+                encoder's linear layers. CPU only; ignored with a warning on CUDA.
+            dtype: Optional floating point type for the unquantized Phi-2 weights.
+                If None, FP16 on CUDA and BF16 on CPUs with native BF16 support,
+                otherwise FP32.
         """
         self.device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+        self.quantization = quantization
+        self.gguf_path = gguf_path
+        self.compile_embeddings = compile_embeddings
+        self.quantize_embeddings = quantize_embeddings
+        self.dtype = dtype
+        self.llm = None
+        # llama.cpp contexts are not thread-safe, so generations through them are serialized
+        self._llm_lock = threading.Lock()
+        # Key/value cache of a fixed prompt prefix shared by every generation
+        self._prefix_ids: Optional[torch.Tensor] = None
+        self._prefix_cache: Optional[DynamicCache] = None
         logger.info(f"Using device: {self.device}")
         
         # Initialize models
         self._init_phi2_model()
         self._init_embedding_model()
+        
+        # Per-instance memo of single-text embeddings (repeated questions skip the encoder)
+        self._cached_embedding = lru_cache(maxsize=2048)(self._encode_text)
 
     def _init_phi2_model(self):
         """Initialize the Phi-2 model for text generation."""
+        if self.gguf_path:
+            self._init_gguf_model()
+            return
+        
         try:
             model_name = "microsoft/phi-2"
             logger.info(f"Loading {model_name}...")
             
-            self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+            self.tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+            # Phi-2 ships without a pad token; reuse EOS so batched inputs can be padded
+            if self.tokenizer.pad_token is None:
+                self.tokenizer.pad_token = self.tokenizer.eos_token
+            # Decoder-only generation continues from the last position, so pad on the left
+            self.tokenizer.padding_side = "left"
+            quantization_config = self._quantization_config()
+            # Quantized weights carry their own storage and compute dtypes
+            torch_dtype = None if quantization_config else self._select_dtype()
+            if torch_dtype is not None:
+                logger.info(f"Loading {model_name} weights as {torch_dtype}")
             self.model = AutoModelForCausalLM.from_pretrained(
                 model_name,
-                torch_dtype=torch.float16 if self.device == 'cuda' else torch.float32,
-                device_map="auto",
+                torch_dtype=torch_dtype,
+                quantization_config=quantization_config,
+                # "auto" may shard across GPUs; on CPU keep the weights where we were asked to
+                device_map="auto" if self.device == 'cuda' else self.device,
                 trust_remote_code=True
             )
             
+            if self.quantization == 'fp8' and self.device == 'cuda':
+                self._quantize_fp8()
+            
             logger.info(f"Successfully loaded {model_name}")
         except Exception as e:
             logger.error(f"Error loading Phi-2 model: {str(e)}")
             raise
 
+    def _init_gguf_model(self):
+        """Initialize a GGUF Phi-2 checkpoint with llama.cpp for text generation."""
+        try:
+            from llama_cpp import Llama
+        except ImportError as e:
+            raise ImportError("llama-cpp-python is required to load GGUF models") from e
+        
+        try:
+            logger.info(f"Loading {self.gguf_path}...")
+            
+            self.llm = Llama(
+                model_path=self.gguf_path,
+                n_ctx=2048,
+                n_threads=os.cpu_count(),
+                n_gpu_layers=-1 if self.device == 'cuda' else 0,
+                verbose=False
+            )
+            
+            logger.info(f"Successfully loaded {self.gguf_path}")
+        except Exception as e:
+            logger.error(f"Error loading GGUF model: {str(e)}")
+            raise
+
+    def _select_dtype(self) -> torch.dtype:
+        """Pick the narrowest floating point type the device computes natively."""
+        if self.dtype is not None:
+            return self.dtype
+        if self.device == 'cuda':
+            # FP8 weight-only kernels dequantize into BF16
+            return torch.bfloat16 if self.quantization == 'fp8' else torch.float16
+        # BF16 halves weight bandwidth on CPUs with AVX512-BF16/AMX, but is emulated elsewhere
+        return torch.bfloat16 if self._cpu_supports_bf16() else torch.float32
+
+    def _cpu_supports_bf16(self) -> bool:
+        """Check the CPU feature flags reported by Linux for native BF16 instructions."""
+        try:
+            with open('/proc/cpuinfo') as f:
+                flags = next((line.split(':', 1)[1].split() for line in f if line.startswith('flags')), [])
+        except OSError:
+            # No /proc (e.g. macOS or Windows); stay on FP32
+            return False
+        return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+    def _quantization_config(self) -> Optional[BitsAndBytesConfig]:
+        """Build the bitsandbytes config for the requested weight quantization."""
+        if self.quantization is None:
+            return None
+        
+        if self.quantization not in ('8bit', '4bit', 'fp8'):
+            raise ValueError(f"Unknown quantization: {self.quantization}")
+        
+        if self.device != 'cuda':
+            logger.warning(f"{self.quantization} quantization requires CUDA; loading unquantized weights")
+            return None
+        
+        if self.quantization == 'fp8':
+            # Applied with torchao after loading, see _quantize_fp8
+            return None
+        
+        if self.quantization == '8bit':
+            return BitsAndBytesConfig(load_in_8bit=True)
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.float16,
+            bnb_4bit_use_double_quant=True
+        )
+
+    def _quantize_fp8(self):
+        """Quantize Phi-2's linear layers to FP8 (E4M3) weights with torchao."""
+        try:
+            from torchao.quantization import Float8WeightOnlyConfig, quantize_
+        except ImportError as e:
+            raise ImportError("torchao is required for fp8 quantization") from e
+        
+        # The first and last decoder blocks and the LM head are the most sensitive
+        # to FP8 rounding and are left in BF16
+        last_layer = self.model.config.num_hidden_layers - 1
+        skipped = ("layers.0.", f"layers.{last_layer}.", "lm_head")
+        
+        def is_quantized(module: torch.nn.Module, name: str) -> bool:
+            return isinstance(module, torch.nn.Linear) and not any(part in name for part in skipped)
+        
+        quantize_(self.model, Float8WeightOnlyConfig(), filter_fn=is_quantized)
+        logger.info("Quantized Phi-2 linear layers to FP8")
+
     def _init_embedding_model(self):
         """Initialize the sentence transformer model for embeddings."""
         try:
@@ -54,49 +198,216 @@ class ModelManager:
             self.embedding_model = SentenceTransformer(model_name)
             self.embedding_model.to(self.device)
             
+            # Names the encoder configuration; variants produce slightly different vectors
+            variant = ['fp32']
+            if self.quantize_embeddings and self._quantize_embedding_model():
+                variant = ['int8']
+            
+            if self.compile_embeddings:
+                variant.append('compiled')
+                # Sequence lengths vary per batch, so compile for dynamic shapes
+                transformer = self.embedding_model[0]
+                transformer.auto_model = torch.compile(
+                    transformer.auto_model,
+                    mode="reduce-overhead",
+                    dynamic=True
+                )
+            
+            self.embedding_variant = '-'.join(variant)
             logger.info(f"Successfully loaded {model_name}")
         except Exception as e:
             logger.error(f"Error loading embedding model: {str(e)}")
             raise
 
+    def _quantize_embedding_model(self) -> bool:
+        """Swap the embedding encoder's linear layers for dynamic INT8 kernels; return whether it did."""
+        if self.device != 'cpu':
+            logger.warning("Dynamic INT8 quantization only runs on CPU; keeping FP32 embedding model")
+            return False
+        
+        transformer = self.embedding_model[0]
+        transformer.auto_model = torch.quantization.quantize_dynamic(
+            transformer.auto_model,
+            {torch.nn.Linear},
+            dtype=torch.qint8
+        )
+        logger.info("Quantized embedding model linear layers to INT8")
+        return True
+
     def generate_text(self, prompt: str, max_length: int = 512) -> str:
         """
         Generate text using the Phi-2 model.
         
         Args:
             prompt: Input text prompt
-            max_length: Maximum length of generated text
+            max_length: Maximum length of generated text, prompt included
             
         Returns:
-            Generated text response
+            Generated continuation of the prompt, without the prompt itself
         """
         try:
-            inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
-            outputs = self.model.generate(
-                **inputs,
-                max_length=max_length,
-                num_return_sequences=1,
-                temperature=0.7,
-                do_sample=True,
-                pad_token_id=self.tokenizer.eos_token_id
-            )
-            return self.tokenizer.decode(outputs[0], skip_special_tokens=True)
+            if self.llm is not None:
+                return self._generate_gguf(prompt, max_length)
+            
+            inputs = self._tokenize([prompt])
+            with torch.inference_mode():
+                outputs = self.model.generate(
+                    **inputs,
+                    max_length=max_length,
+                    num_return_sequences=1,
+                    temperature=0.7,
+                    do_sample=True,
+                    pad_token_id=self.tokenizer.pad_token_id,
+                    past_key_values=self._prefix_cache_for(inputs["input_ids"][0]),
+                    use_cache=True
+                )
+            # Decode only the new tokens; the output starts with the prompt
+            return self.tokenizer.decode(
+                outputs[0, inputs["input_ids"].shape[1]:], skip_special_tokens=True
+            ).strip()
         except Exception as e:
             logger.error(f"Error in text generation: {str(e)}")
             raise
 
-    def get_embeddings(self, texts: List[str]) -> torch.Tensor:
+    def set_prompt_prefix(self, prefix: str):
+        """
+        Precompute the key/value cache for a prefix shared by all prompts.
+        
+        Prompts passed to generate_text that start with the same tokens skip
+        the forward pass over the prefix.
+        
+        Args:
+            prefix: Fixed leading text of every prompt
+        """
+        if self.llm is not None:
+            # llama.cpp reuses matching prompt prefixes on its own
+            return
+        
+        try:
+            prefix_ids = self.tokenizer(prefix, return_tensors="pt")["input_ids"].to(self.model.device)
+            cache = DynamicCache()
+            with torch.inference_mode():
+                self.model(input_ids=prefix_ids, past_key_values=cache, use_cache=True)
+            
+            self._prefix_ids = prefix_ids[0]
+            self._prefix_cache = cache
+            logger.info(f"Cached prompt prefix of {len(self._prefix_ids)} tokens")
+        except Exception as e:
+            logger.error(f"Error caching prompt prefix: {str(e)}")
+            raise
+
+    def _prefix_cache_for(self, input_ids: torch.Tensor) -> Optional[DynamicCache]:
+        """Return a private copy of the prefix cache if the prompt starts with the prefix."""
+        if self._prefix_cache is None:
+            return None
+        
+        prefix_length = len(self._prefix_ids)
+        # Tokenization must line up exactly, and at least one token must remain to process
+        if len(input_ids) <= prefix_length or not torch.equal(input_ids[:prefix_length], self._prefix_ids):
+            return None
+        
+        # generate() extends the cache in place, so each call gets its own copy
+        return copy.deepcopy(self._prefix_cache)
+
+    def generate_texts(self, prompts: List[str], max_length: int = 512) -> List[str]:
+        """
+        Generate text for several prompts in one batched Phi-2 call.
+        
+        Args:
+            prompts: Input text prompts
+            max_length: Maximum length of each generated text, prompt included
+            
+        Returns:
+            Generated continuations without the prompts, in the same order as the prompts
+        """
+        try:
+            if self.llm is not None:
+                return [self._generate_gguf(prompt, max_length) for prompt in prompts]
+            
+            inputs = self._tokenize(prompts)
+            with torch.inference_mode():
+                outputs = self.model.generate(
+                    **inputs,
+                    max_length=max_length,
+                    num_return_sequences=1,
+                    temperature=0.7,
+                    do_sample=True,
+                    pad_token_id=self.tokenizer.pad_token_id
+                )
+            # Prompts are left-padded to a common length, so new tokens start at the same column
+            return [
+                text.strip() for text in self.tokenizer.batch_decode(
+                    outputs[:, inputs["input_ids"].shape[1]:], skip_special_tokens=True
+                )
+            ]
+        except Exception as e:
+            logger.error(f"Error in batched text generation: {str(e)}")
+            raise
+
+    def _generate_gguf(self, prompt: str, max_length: int) -> str:
+        """Generate text with llama.cpp, matching the transformers output format."""
+        with self._llm_lock:
+            # max_length counts the prompt, as with transformers' generate
+            prompt_length = len(self.llm.tokenize(prompt.encode("utf-8")))
+            output = self.llm(
+                prompt,
+                max_tokens=max(max_length - prompt_length, 1),
+                temperature=0.7
+            )
+        return output["choices"][0]["text"].strip()
+
+    def _tokenize(self, texts: List[str]) -> Dict[str, torch.Tensor]:
+        """Tokenize a list of texts into padded tensors on the model's device."""
+        return self.tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            return_tensors="pt"
+        ).to(self.model.device)
+
+    def get_embeddings(self, texts: List[str], batch_size: int = 64) -> np.ndarray:
         """
         Generate embeddings for a list of texts.
         
+        Texts are encoded in mini-batches; the encoder sorts them by length
+        internally so each batch is padded as little as possible.
+        
         Args:
             texts: List of input texts
+            batch_size: Number of texts per forward pass
             
         Returns:
-            Tensor of embeddings
+            Array of unit-length float32 embeddings with shape (len(texts), dimension)
         """
         try:
-            return self.embedding_model.encode(texts, convert_to_tensor=True)
+            with torch.inference_mode():
+                return self.embedding_model.encode(
+                    texts,
+                    batch_size=batch_size,
+                    convert_to_numpy=True,
+                    normalize_embeddings=True
+                )
         except Exception as e:
             logger.error(f"Error generating embeddings: {str(e)}")
             raise
+
+    def get_embedding(self, text: str) -> np.ndarray:
+        """
+        Generate the embedding for a single text, memoizing repeated inputs.
+        
+        Args:
+            text: Input text
+            
+        Returns:
+            Read-only embedding array, shared with the memo
+        """
+        # The embedding model is uncased, so case and surrounding whitespace
+        # can be normalized away without changing the result
+        return self._cached_embedding(text.strip().lower())
+
+    def _encode_text(self, text: str) -> np.ndarray:
+        """Encode a single, already normalized text."""
+        embedding = self.get_embeddings([text])[0]
+        # Cached arrays are handed out directly, so guard them against mutation
+        embedding.setflags(write=False)
+        return embedding
@@ -4,29 +4,281 @@ Vector store implementation using FAISS for recipe storage and retrieval.
 
 import faiss
 import numpy as np
-from typing import List, Dict, Tuple, Optional
+import pyarrow as pa
+from collections.abc import Mapping
+from typing import Iterator, List, Dict, Tuple, Optional
+import json
+import operator
 import pickle
 import os
+import shutil
 import logging
-from datetime import datetime
+import time
 
 logger = logging.getLogger(__name__)
 
+class RecipeTable(Mapping):
+    def __init__(self, table: Optional[pa.Table] = None, recipes: Optional[Dict[int, Dict]] = None):
+        """
+        Recipe metadata keyed by recipe ID.
+        
+        Rows loaded from disk stay in a memory-mapped Arrow table and are only
+        decoded when accessed; recipes added afterwards are kept in memory.
+        
+        Args:
+            table: Optional Arrow table with 'recipe_id' and pickled 'recipe'
+                columns, ordered by recipe ID starting at 0
+            recipes: Optional in-memory recipes keyed by ID
+        """
+        self._table = table
+        self._stored = table.num_rows if table is not None else 0
+        self._added: Dict[int, Dict] = dict(recipes or {})
+
+    def _stored_id(self, recipe_id) -> Optional[int]:
+        """Return recipe_id as an int if it names a row of the loaded table, else None."""
+        try:
+            recipe_id = operator.index(recipe_id)
+        except TypeError:
+            return None
+        return recipe_id if 0 <= recipe_id < self._stored else None
+
+    def __getitem__(self, recipe_id: int) -> Dict:
+        if recipe_id in self._added:
+            return self._added[recipe_id]
+        row = self._stored_id(recipe_id)
+        if row is None:
+            raise KeyError(recipe_id)
+        column = self._table.column('recipe')
+        if pa.types.is_string(column.type):
+            # Tables saved before recipes were pickled per row stored JSON
+            return json.loads(column[row].as_py())
+        return pickle.loads(column[row].as_py())
+
+    def __contains__(self, recipe_id) -> bool:
+        # Avoid Mapping.__contains__, which would decode the row
+        return recipe_id in self._added or self._stored_id(recipe_id) is not None
+
+    def __setitem__(self, recipe_id: int, recipe_data: Dict):
+        self._added[recipe_id] = recipe_data
+
+    def __len__(self) -> int:
+        return self._stored + len(self._added)
+
+    def __iter__(self) -> Iterator[int]:
+        yield from range(self._stored)
+        yield from self._added
+
+    def to_table(self) -> pa.Table:
+        """Materialize all recipes into an Arrow table for saving."""
+        recipe_ids = list(self)
+        # Pickle each row so metadata keeps any Python value, as the dict format did
+        return pa.table({
+            'recipe_id': pa.array(recipe_ids, type=pa.int64()),
+            'recipe': pa.array([pickle.dumps(self[recipe_id]) for recipe_id in recipe_ids], type=pa.binary())
+        })
+
 class RecipeVectorStore:
-    def __init__(self, dimension: int = 384, index_path: Optional[str] = None):
+    def __init__(
+        self,
+        dimension: int = 384,
+        index_path: Optional[str] = None,
+        index_type: str = 'flat',
+        nlist: int = 100,
+        pq_m: int = 48,
+        use_gpu: bool = False,
+        mmap: bool = False
+    ):
         """
         Initialize the FAISS vector store for recipes.
         
         Args:
             dimension: Dimension of the embedding vectors (384 for all-MiniLM-L6-v2)
             index_path: Optional path to load existing index
+            index_type: FAISS index structure: 'flat' (exact search), 'hnsw'
+                (graph-based approximate search, suited to up to ~1M recipes),
+                'ivf' (inverted file), 'ivfpq' (inverted file over 8-bit product
+                quantization codes, for larger corpora) or 'pq_fastscan' (4-bit
+                product quantization with SIMD scanning) or 'binary' (sign bits
+                compared by Hamming distance; dimension must be a multiple of 8).
+                'ivf', 'ivfpq' and 'pq_fastscan' need training; until enough
+                recipes for that have been added (see min_training_points: 39 *
+                nlist for 'ivf', 39 * max(nlist, 256) for 'ivfpq', 624 for
+                'pq_fastscan') they are kept and searched exactly in a flat
+                staging index
+            nlist: Number of IVF cells, roughly sqrt of the expected corpus size
+            pq_m: Number of product-quantizer sub-vectors; must divide dimension
+            use_gpu: Keep the index on the first GPU when FAISS was built with GPU
+                support and the index type has a GPU implementation
+            mmap: Load the index at index_path read-only, memory-mapping the
+                inverted lists of 'ivf' and 'ivfpq' indexes (see load)
         """
         self.dimension = dimension
-        self.index = faiss.IndexFlatL2(dimension)
-        self.recipes: Dict[int, Dict] = {}  # Map IDs to recipe data
+        self.index_type = index_type
+        self.nlist = nlist
+        self.pq_m = pq_m
+        self.use_gpu = use_gpu
+        self._gpu_resources = None
+        self._on_gpu = False  # Whether self.index was moved to a GPU
+        self.read_only = False
+        self._mapped_path: Optional[str] = None
+        self.index = self._to_gpu(self._create_index())
+        # Exact index holding embeddings added before the main index could be trained
+        self._staging: Optional[faiss.Index] = None if self.index.is_trained else faiss.IndexFlatIP(dimension)
+        self.recipes = RecipeTable()  # Map IDs to recipe data
+        
+        if index_path and os.path.exists(f"{index_path}.index"):
+            self.load(index_path, mmap=mmap)
+
+    def _create_index(self) -> faiss.Index:
+        """Create an empty FAISS index of the configured type."""
+        # Embeddings are unit length, so inner product equals cosine similarity
+        if self.index_type == 'flat':
+            return faiss.IndexFlatIP(self.dimension)
+        
+        if self.index_type == 'hnsw':
+            index = faiss.IndexHNSWFlat(self.dimension, 32, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = 200
+            index.hnsw.efSearch = 64
+            return index
+        
+        if self.index_type in ('ivf', 'ivfpq'):
+            quantizer = faiss.IndexFlatIP(self.dimension)
+            if self.index_type == 'ivf':
+                index = faiss.IndexIVFFlat(
+                    quantizer, self.dimension, self.nlist, faiss.METRIC_INNER_PRODUCT
+                )
+            else:
+                index = faiss.IndexIVFPQ(
+                    quantizer, self.dimension, self.nlist, self.pq_m, 8, faiss.METRIC_INNER_PRODUCT
+                )
+            index.nprobe = 8
+            index.make_direct_map()  # Allows stored vectors to be reconstructed by ID
+            return index
+        
+        if self.index_type == 'pq_fastscan':
+            # 4-bit codes are laid out so SIMD table lookups score many vectors at once
+            return faiss.IndexPQFastScan(self.dimension, self.pq_m, 4, faiss.METRIC_INNER_PRODUCT)
+        
+        if self.index_type == 'binary':
+            # One bit per dimension; Hamming distance runs on POPCNT
+            return faiss.IndexBinaryFlat(self.dimension)
+        
+        raise ValueError(f"Unknown index type: {self.index_type}")
+
+    def _to_gpu(self, index: faiss.Index) -> faiss.Index:
+        """
+        Move the index to the GPU if requested and supported, else return it unchanged.
+        
+        The result must be assigned to self.index, whose placement is recorded here.
+        """
+        self._on_gpu = False
+        if not self.use_gpu or self.index_type == 'binary':
+            return index
+        
+        if not hasattr(faiss, 'StandardGpuResources') or faiss.get_num_gpus() == 0:
+            logger.info("FAISS GPU support is not available; keeping index on CPU")
+            return index
         
-        if index_path and os.path.exists(index_path):
-            self.load(index_path)
+        try:
+            if self._gpu_resources is None:
+                self._gpu_resources = faiss.StandardGpuResources()
+            gpu_index = faiss.index_cpu_to_gpu(self._gpu_resources, 0, index)
+        except RuntimeError as e:
+            logger.info(f"Keeping {self.index_type} index on CPU: {str(e)}")
+            return index
+        
+        self._on_gpu = True
+        return gpu_index
+
+    def _to_unit_vectors(self, embeddings: np.ndarray) -> np.ndarray:
+        """Return L2-normalized float32 copies of the embeddings with shape (n, d)."""
+        vectors = np.array(embeddings, dtype=np.float32).reshape(-1, embeddings.shape[-1])
+        faiss.normalize_L2(vectors)
+        return vectors
+
+    def _index_vectors(self, vectors: np.ndarray) -> np.ndarray:
+        """Convert unit vectors to the representation stored in the index."""
+        if self.index_type == 'binary':
+            return np.packbits(vectors > 0, axis=-1)
+        return vectors
+
+    def _to_similarities(self, scores: np.ndarray) -> np.ndarray:
+        """Convert raw index scores to cosine similarities (approximate for 'binary')."""
+        if self.index_type == 'binary':
+            # Hamming distance h over d sign bits estimates the angle as pi * h / d;
+            # the linear map below spans the same [-1, 1] range as cosine
+            return 1.0 - 2.0 * scores.astype(np.float32) / self.dimension
+        return scores
+
+    @property
+    def is_trained(self) -> bool:
+        """Whether the main index has been trained (added recipes are staged until then)."""
+        return self.index.is_trained
+
+    @property
+    def min_training_points(self) -> int:
+        """Number of staged embeddings at which the index trains itself."""
+        if self.index.is_trained:
+            return 0
+        # FAISS k-means wants about 39 training points per centroid
+        if self.index_type == 'ivfpq':
+            # Each 8-bit product-quantizer codebook has 256 centroids
+            return 39 * max(self.nlist, 256)
+        if self.index_type == 'pq_fastscan':
+            # 4-bit codebooks have 16 centroids
+            return 39 * 16
+        return 39 * self.nlist
+
+    @property
+    def _active_index(self) -> faiss.Index:
+        """The index currently holding the stored embeddings."""
+        return self.index if self._staging is None else self._staging
+
+    def train(self, embeddings: np.ndarray):
+        """
+        Train the index on a representative sample of embeddings.
+        
+        Only needed for index types that cluster or quantize the vector space
+        ('ivf', 'ivfpq', 'pq_fastscan'), and only to train earlier than the
+        automatic training on staged recipes; a no-op for indexes that are
+        already trained.
+        
+        Args:
+            embeddings: Array of shape (n, dimension) used for training
+        """
+        try:
+            if self.index.is_trained:
+                return
+            
+            embeddings = self._to_unit_vectors(embeddings)
+            if len(embeddings) < self.min_training_points:
+                logger.warning(
+                    f"Training {self.index_type} index on {len(embeddings)} embeddings; "
+                    f"at least {self.min_training_points} are recommended"
+                )
+            self.index.train(embeddings)
+            
+            logger.info(f"Trained {self.index_type} index on {len(embeddings)} embeddings")
+            
+            # Staged recipes keep their IDs, so they move over before any new ones
+            if self._staging is not None:
+                if self._staging.ntotal:
+                    self.index.add(self._staging.reconstruct_n(0, self._staging.ntotal))
+                self._staging = None
+            
+        except Exception as e:
+            logger.error(f"Error training index: {str(e)}")
+            raise
+
+    def _insert(self, vectors: np.ndarray):
+        """Add unit vectors to the index, staging them until it can be trained."""
+        if self._staging is None:
+            self.index.add(self._index_vectors(vectors))
+            return
+        
+        self._staging.add(vectors)
+        if self._staging.ntotal >= self.min_training_points:
+            self.train(self._staging.reconstruct_n(0, self._staging.ntotal))
 
     def add_recipe(self, recipe_data: Dict, embedding: np.ndarray) -> int:
         """
@@ -40,19 +292,21 @@ class RecipeVectorStore:
             Recipe ID
         """
         try:
-            # Ensure embedding is the correct shape
-            embedding = embedding.reshape(1, -1)
+            # Ensure embedding is a unit-length float32 row
+            embedding = self._to_unit_vectors(embedding)
             if embedding.shape[1] != self.dimension:
                 raise ValueError(f"Embedding dimension mismatch. Expected {self.dimension}, got {embedding.shape[1]}")
+            if self.read_only:
+                raise RuntimeError("Cannot add recipes to a memory-mapped read-only index")
             
             # Add to FAISS index
             recipe_id = len(self.recipes)
-            self.index.add(embedding)
+            self._insert(embedding)
             
             # Store recipe data
             self.recipes[recipe_id] = {
                 **recipe_data,
-                'added_at': datetime.now().isoformat()
+                'added_at_ns': time.time_ns()
             }
             
             logger.info(f"Added recipe '{recipe_data.get('title', 'Untitled')}' with ID {recipe_id}")
@@ -62,6 +316,44 @@ class RecipeVectorStore:
             logger.error(f"Error adding recipe: {str(e)}")
             raise
 
+    def add_recipes(self, recipes: List[Dict], embeddings: np.ndarray) -> List[int]:
+        """
+        Add several recipes and their embeddings with a single index insert.
+        
+        Args:
+            recipes: List of dictionaries containing recipe information
+            embeddings: Array of shape (len(recipes), dimension)
+            
+        Returns:
+            List of recipe IDs, in the same order as the input
+        """
+        try:
+            embeddings = self._to_unit_vectors(embeddings)
+            if embeddings.shape != (len(recipes), self.dimension):
+                raise ValueError(f"Expected embeddings of shape ({len(recipes)}, {self.dimension}), got {embeddings.shape}")
+            if self.read_only:
+                raise RuntimeError("Cannot add recipes to a memory-mapped read-only index")
+            
+            # Add to FAISS index in one call
+            first_id = len(self.recipes)
+            self._insert(embeddings)
+            
+            # Store recipe data
+            added_at_ns = time.time_ns()
+            recipe_ids = list(range(first_id, first_id + len(recipes)))
+            for recipe_id, recipe_data in zip(recipe_ids, recipes):
+                self.recipes[recipe_id] = {
+                    **recipe_data,
+                    'added_at_ns': added_at_ns
+                }
+            
+            logger.info(f"Added {len(recipes)} recipes with IDs {first_id}-{first_id + len(recipes) - 1}")
+            return recipe_ids
+            
+        except Exception as e:
+            logger.error(f"Error adding recipes: {str(e)}")
+            raise
+
     def search_recipes(
         self, 
         query_embedding: np.ndarray, 
@@ -75,22 +367,30 @@ class RecipeVectorStore:
             k: Number of results to return
             
         Returns:
-            List of tuples containing (recipe_id, distance, recipe_data)
+            List of tuples containing (recipe_id, cosine_similarity, recipe_data)
         """
         try:
-            # Reshape query embedding
-            query_embedding = query_embedding.reshape(1, -1)
+            # Normalize query embedding
+            query_embedding = self._to_unit_vectors(query_embedding)
             
             # Search the FAISS index
-            distances, indices = self.index.search(query_embedding, k)
+            if self._staging is not None:
+                # Staged embeddings are stored as exact float vectors
+                scores, indices = self._staging.search(query_embedding, k)
+                similarities = scores
+            else:
+                scores, indices = self.index.search(self._index_vectors(query_embedding), k)
+                similarities = self._to_similarities(scores)
+            
+            # Drop empty slots (FAISS returns -1) and convert to Python scalars in one pass
+            found = indices[0] >= 0
             
             # Format results
             results = []
-            for idx, (distance, recipe_idx) in enumerate(zip(distances[0], indices[0])):
-                if recipe_idx >= 0:  # FAISS returns -1 for empty slots
-                    recipe_data = self.recipes.get(int(recipe_idx))
-                    if recipe_data:
-                        results.append((int(recipe_idx), float(distance), recipe_data))
+            for recipe_idx, similarity in zip(indices[0][found].tolist(), similarities[0][found].tolist()):
+                recipe_data = self.recipes.get(recipe_idx)
+                if recipe_data:
+                    results.append((recipe_idx, similarity, recipe_data))
             
             return results
             
@@ -106,12 +406,37 @@ class RecipeVectorStore:
             path: Path to save the index and metadata
         """
         try:
-            # Save FAISS index
-            faiss.write_index(self.index, f"{path}.index")
+            # Both files are written to temporary paths and only moved into place
+            # once both succeeded, so a failed save never leaves an index and
+            # metadata that disagree; the current files may also still be
+            # memory-mapped by this store
+            # The index settings travel with the metadata so load can restore them
+            table = self.recipes.to_table().replace_schema_metadata({
+                'index_type': self.index_type,
+                'nlist': str(self.nlist),
+                'pq_m': str(self.pq_m)
+            })
+            with pa.OSFile(f"{path}.arrow.tmp", 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            
+            # Save FAISS index (GPU indexes are serialized through a CPU copy);
+            # an index that is not trained yet is saved as its staging index
+            if self.read_only:
+                # A memory-mapped index cannot change, and FAISS cannot serialize
+                # mapped inverted lists, so copy the file it was mapped from
+                shutil.copyfile(self._mapped_path, f"{path}.index.tmp")
+            elif self._staging is not None:
+                faiss.write_index(self._staging, f"{path}.index.tmp")
+            else:
+                index = faiss.index_gpu_to_cpu(self.index) if self._on_gpu else self.index
+                if self.index_type == 'binary':
+                    faiss.write_index_binary(index, f"{path}.index.tmp")
+                else:
+                    faiss.write_index(index, f"{path}.index.tmp")
             
-            # Save recipe metadata
-            with open(f"{path}.metadata", 'wb') as f:
-                pickle.dump(self.recipes, f)
+            os.replace(f"{path}.index.tmp", f"{path}.index")
+            os.replace(f"{path}.arrow.tmp", f"{path}.arrow")
                 
             logger.info(f"Saved vector store to {path}")
             
@@ -119,27 +444,133 @@ class RecipeVectorStore:
             logger.error(f"Error saving vector store: {str(e)}")
             raise
 
-    def load(self, path: str):
+    def _prefetch(self, path: str):
+        """Ask the kernel to start reading a file into the page cache in the background."""
+        if not hasattr(os, 'posix_fadvise'):
+            return
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, os.fstat(fd).st_size, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            # Advice only; some filesystems do not support it
+            pass
+        finally:
+            os.close(fd)
+
+    def _is_binary_index_file(self, path: str) -> bool:
+        """Whether a FAISS index file holds a binary index (their type codes start with 'IB')."""
+        with open(path, 'rb') as f:
+            return f.read(2) == b'IB'
+
+    def _index_type_of(self, index: faiss.Index) -> str:
+        """Name the index type of a float index read from a store saved without its settings."""
+        index = faiss.downcast_index(index)
+        for index_class, index_type in (
+            (faiss.IndexHNSWFlat, 'hnsw'),
+            (faiss.IndexIVFFlat, 'ivf'),
+            (faiss.IndexIVFPQ, 'ivfpq'),
+            (faiss.IndexPQFastScan, 'pq_fastscan'),
+            (faiss.IndexFlat, 'flat')
+        ):
+            if isinstance(index, index_class):
+                return index_type
+        raise ValueError(f"Unsupported FAISS index class: {type(index).__name__}")
+
+    def load(self, path: str, mmap: bool = False):
         """
         Load the vector store from disk.
         
+        The index type, dimension and training settings are taken from the saved
+        store rather than from the constructor arguments.
+        
         Args:
             path: Path to load the index and metadata from
+            mmap: Load the index read-only. FAISS only memory-maps IVF inverted
+                lists, so for trained 'ivf' and 'ivfpq' indexes the vector codes
+                are paged in on demand and shared between processes; other index
+                types are still read into RAM. The loaded store cannot accept
+                new recipes
         """
         try:
+            # Queue readahead for both files so the metadata read overlaps index I/O
+            self._prefetch(f"{path}.index")
+            if os.path.exists(f"{path}.arrow"):
+                self._prefetch(f"{path}.arrow")
+            
+            # Load recipe metadata; rows are decoded lazily from the mapped file
+            settings = {}
+            if os.path.exists(f"{path}.arrow"):
+                source = pa.memory_map(f"{path}.arrow", 'r')
+                table = pa.ipc.open_file(source).read_all()
+                self.recipes = RecipeTable(table=table)
+                settings = {
+                    key.decode(): value.decode()
+                    for key, value in (table.schema.metadata or {}).items()
+                }
+            else:
+                # Stores saved before the Arrow format pickled the whole dict
+                with open(f"{path}.metadata", 'rb') as f:
+                    self.recipes = RecipeTable(recipes=pickle.load(f))
+            
             # Load FAISS index
-            self.index = faiss.read_index(f"{path}.index")
+            io_flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if mmap else 0
+            self._staging = None
+            configured_type = self.index_type
+            if self._is_binary_index_file(f"{path}.index"):
+                self.index_type = 'binary'
+                self.index = faiss.read_index_binary(f"{path}.index", io_flags)
+                self._on_gpu = False
+            else:
+                index = faiss.read_index(f"{path}.index", io_flags)
+                self.index_type = settings.get('index_type') or self._index_type_of(index)
+                self.nlist = int(settings.get('nlist', self.nlist))
+                self.pq_m = int(settings.get('pq_m', self.pq_m))
+                self.dimension = index.d
+                trainable = self.index_type in ('ivf', 'ivfpq', 'pq_fastscan')
+                if trainable and isinstance(faiss.downcast_index(index), faiss.IndexFlat):
+                    # Saved before it had enough recipes to train; keep staging
+                    self._staging = index
+                    index = self._create_index()
+                self.index = self._to_gpu(index)
+            self.dimension = self.index.d
+            if self.index_type != configured_type:
+                logger.info(f"Store at {path} holds a {self.index_type} index; ignoring index_type={configured_type}")
+            self.read_only = mmap
+            self._mapped_path = f"{path}.index" if mmap else None
+            if mmap and (self._staging is not None or self.index_type not in ('ivf', 'ivfpq')):
+                logger.warning(
+                    f"Only IVF inverted lists can be memory-mapped; the {self.index_type} "
+                    f"index at {path} was read into RAM and loaded read-only"
+                )
+            if self.index_type != 'binary' and self._active_index.metric_type != faiss.METRIC_INNER_PRODUCT:
+                logger.warning(f"Index at {path} does not use inner product; similarity scores will be wrong until it is rebuilt")
             
-            # Load recipe metadata
-            with open(f"{path}.metadata", 'rb') as f:
-                self.recipes = pickle.load(f)
-                
             logger.info(f"Loaded vector store from {path} with {len(self.recipes)} recipes")
             
         except Exception as e:
             logger.error(f"Error loading vector store: {str(e)}")
             raise
 
+    def get_embedding(self, recipe_id: int) -> Optional[np.ndarray]:
+        """
+        Get the stored embedding of a recipe by ID.
+        
+        Args:
+            recipe_id: Recipe ID
+            
+        Returns:
+            Embedding vector, or None if the index cannot return it exactly
+        """
+        # Quantized and binary codes only approximate the vector, so callers
+        # should re-encode the recipe instead; staged embeddings are exact
+        exact = self._staging is not None or self.index_type in ('flat', 'hnsw', 'ivf')
+        if not exact or recipe_id not in self.recipes:
+            return None
+        try:
+            return self._active_index.reconstruct(int(recipe_id))
+        except RuntimeError:
+            return None
+
     def get_recipe(self, recipe_id: int) -> Optional[Dict]:
         """
         Get recipe data by ID.
@@ -8,9 +8,11 @@ import logging
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
+STATE_PATH = "recipe_assistant_state"
+
 def main():
-    # Initialize the assistant
-    assistant = RecipeAssistant()
+    # Initialize the assistant, reusing the saved index from a previous run if present
+    assistant = RecipeAssistant(vector_store_path=STATE_PATH)
     
     # Example recipe data
     chocolate_cake = {
@@ -39,9 +41,13 @@ def main():
         'tags': ['dessert', 'chocolate', 'cake', 'baking']
     }
     
-    # Add recipe to assistant
-    recipe_id = assistant.add_recipe(chocolate_cake)
-    print(f"Added recipe with ID: {recipe_id}")
+    # Add recipe to assistant (skipped when it was loaded from disk)
+    if assistant.vector_store.get_recipe(0) is None:
+        recipe_id = assistant.add_recipe(chocolate_cake)
+        print(f"Added recipe with ID: {recipe_id}")
+    else:
+        recipe_id = 0
+        print(f"Loaded recipe with ID: {recipe_id}")
     
     # Example queries
     questions = [
@@ -50,9 +56,9 @@ def main():
         "How would I adjust the recipe to make a smaller portion?"
     ]
     
-    for question in questions:
+    responses = assistant.query_batch(questions)
+    for question, response in zip(questions, responses):
         print(f"\nQuestion: {question}")
-        response = assistant.query(question)
         print(f"Response: {response}")
     
     # Find similar recipes
@@ -62,7 +68,7 @@ def main():
         print(f"- {recipe['recipe']['title']} (Similarity: {recipe['similarity_score']:.2f})")
     
     # Save the assistant's state
-    assistant.save_state("recipe_assistant_state")
+    assistant.save_state(STATE_PATH)
 
 if __name__ == "__main__":
     main()